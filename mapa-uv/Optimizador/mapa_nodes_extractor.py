@@ -17,9 +17,15 @@ Notas:
 - Extrae puntos de <polyline>, <polygon>, <path> (heurístico), <circle>, <rect> (centro).
 - Si un elemento SVG tiene atributo `id`, se intenta mantenerlo como id de nodo.
 - Agrupa puntos cercanos (tolerancia configurable) para evitar duplicados.
+- Guarda junto a la salida un manifiesto (<salida>.manifest.json) con el hash de
+  contenido de cada elemento. En la siguiente ejecución sólo se reextraen los
+  elementos añadidos, modificados o eliminados y se parchea el grafo existente,
+  de modo que los ids de nodos no cambian (`--full` fuerza la extracción completa).
+  El manifiesto incluye en `lastChanges` los nodos y aristas añadidos/eliminados.
 """
 from __future__ import annotations
 import argparse
+import hashlib
 import json
 import math
 import re
@@ -83,9 +89,16 @@ def almost_equal(a, b, tol=1e-3):
 
 
 class NodeIndex:
-    def __init__(self, tol=1e-2):
+    def __init__(self, tol=1e-2, taken=(), pool=None, next_seq=0):
         self.tol = tol
         self.nodes = []  # list of dicts {id,x,y,source}
+        self.by_id = {}
+        # ids en uso por nodos que no están en este índice (extracción incremental)
+        self.taken = set(taken)
+        # nodos de la extracción anterior cuyos ids se pueden reutilizar
+        self.pool = dict(pool or {})
+        # los ids nuevos nunca reutilizan un nN ya emitido, aunque se haya borrado
+        self.next_seq = next_seq
 
     def find(self, x, y):
         for n in self.nodes:
@@ -93,95 +106,363 @@ class NodeIndex:
                 return n['id']
         return None
 
+    def _used(self, nid):
+        return nid in self.by_id or nid in self.taken
+
+    def _reuse_id(self, x, y):
+        """Id del nodo de la reserva más cercano dentro de la tolerancia, o None."""
+        best_id, best_d = None, self.tol
+        for nid, n in self.pool.items():
+            d = math.hypot(n['x']-x, n['y']-y)
+            if d <= best_d and not self._used(nid):
+                best_id, best_d = nid, d
+        if best_id is not None:
+            del self.pool[best_id]
+        return best_id
+
     def add(self, x, y, preferred_id=None, source='svg'):
         existing = self.find(x,y)
         if existing:
             return existing
-        nid = preferred_id if preferred_id and not any(n['id']==preferred_id for n in self.nodes) else f'n{len(self.nodes)}'
-        self.nodes.append({'id': nid, 'x': x, 'y': y, 'source': source})
+        # el nodo siempre toma x/y/source del punto que lo crea (igual que en una
+        # extracción completa); la reserva sólo decide qué id lleva
+        if preferred_id and not self._used(preferred_id):
+            nid = preferred_id
+            self.pool.pop(nid, None)
+            self.next_seq += 1
+        else:
+            nid = self._reuse_id(x, y)
+            if nid is None:
+                while self._used(f'n{self.next_seq}') or f'n{self.next_seq}' in self.pool:
+                    self.next_seq += 1
+                nid = f'n{self.next_seq}'
+                self.next_seq += 1
+        node = {'id': nid, 'x': x, 'y': y, 'source': source}
+        self.nodes.append(node)
+        self.by_id[nid] = node
         return nid
 
 
-def extract(svg_path: Path, tolerance: float=1.0):
-    tree = ET.parse(svg_path)
-    root = tree.getroot()
-    # Handle namespace: get local-name by splitting '}'
-    ns = ''
-    if root.tag.startswith('{'):
-        ns = root.tag.split('}')[0].strip('{')
+MANIFEST_VERSION = 2
+# atributos que determinan lo que aporta cada elemento al grafo
+HASHED_ATTRS = ('id', 'class', 'points', 'd', 'cx', 'cy', 'x', 'y', 'width', 'height')
+GRAPH_TAGS = ('polyline', 'polygon', 'path', 'circle', 'rect')
 
-    def local(tag):
-        return f'{{{ns}}}{tag}' if ns else tag
 
-    index = NodeIndex(tol=tolerance)
-    edges = []
-    buildings = []
+def default_manifest_path(out_path: Path) -> Path:
+    return out_path.with_name(out_path.stem + '.manifest.json')
+
+
+def element_tag(el):
+    tag = el.tag
+    if not isinstance(tag, str):
+        return None
+    if '}' in tag:
+        tag = tag.split('}',1)[1]
+    return tag.lower()
+
+
+def element_hash(tag, el):
+    payload = json.dumps([tag] + [el.get(a) for a in HASHED_ATTRS], ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
 
-    # Iterate elements
+def iter_graph_elements(root):
+    """Devuelve [(key, hash, tag, el)] en orden de documento.
+
+    La clave es el hash de contenido más un contador de repeticiones, así que
+    no depende de la posición del elemento: insertar o borrar uno no cambia
+    la clave de los demás. Un elemento editado aparece como borrado + añadido.
+    """
+    seen = {}
+    out = []
     for el in root.iter():
-        tag = el.tag
-        if isinstance(tag, str) and '}' in tag:
-            tag_local = tag.split('}',1)[1]
-        else:
-            tag_local = tag
-        tag_local = tag_local.lower()
-
-        # polyline / polygon
-        if tag_local in ('polyline','polygon'):
-            pts_attr = el.get('points') or ''
-            pts = parse_points_list(pts_attr)
-            prev_id = None
-            for (x,y) in pts:
-                nid = index.add(x,y, source=tag_local)
-                if prev_id and nid != prev_id:
-                    dist = math.hypot(x - next(n for n in index.nodes if n['id']==prev_id)['x'], y - next(n for n in index.nodes if n['id']==prev_id)['y'])
-                    edges.append({'from': prev_id, 'to': nid, 'weight': dist})
-                prev_id = nid
-        elif tag_local == 'path':
-            d = el.get('d') or ''
-            pts = parse_path_to_points(d)
-            prev_id = None
-            for (x,y) in pts:
-                nid = index.add(x,y, source='path')
-                if prev_id and nid != prev_id:
-                    a = next(n for n in index.nodes if n['id']==prev_id)
-                    b = next(n for n in index.nodes if n['id']==nid)
+        tag = element_tag(el)
+        if tag not in GRAPH_TAGS:
+            continue
+        h = element_hash(tag, el)
+        k = seen.get(h, 0)
+        seen[h] = k + 1
+        out.append((f'{h}#{k}', h, tag, el))
+    return out
+
+
+def element_points(tag, el):
+    """Puntos (x,y) que un elemento aporta al grafo, sin agrupar."""
+    if tag == 'path':
+        return parse_path_to_points(el.get('d') or '')
+    if tag in ('polyline','polygon'):
+        return parse_points_list(el.get('points') or '')
+    if tag == 'circle':
+        center = circle_center(el.get('cx'), el.get('cy'))
+    elif tag == 'rect':
+        center = rect_center(el.get('x'), el.get('y'), el.get('width'), el.get('height'))
+    else:
+        center = None
+    return [center] if center else []
+
+
+def extract_element(tag, el, index):
+    """Añade los puntos de un elemento al índice.
+
+    Devuelve (ids de nodos tocados, aristas, edificio o None).
+    """
+    node_ids = []
+    edges = []
+    building = None
+    pts = element_points(tag, el)
+    if tag in ('polyline','polygon','path'):
+        prev_id = None
+        for (x,y) in pts:
+            nid = index.add(x,y, source=tag)
+            node_ids.append(nid)
+            if prev_id and nid != prev_id:
+                a = index.by_id[prev_id]
+                if tag == 'path':
+                    b = index.by_id[nid]
                     dist = math.hypot(b['x']-a['x'], b['y']-a['y'])
-                    edges.append({'from': prev_id, 'to': nid, 'weight': dist})
-                prev_id = nid
-        elif tag_local == 'circle':
-            cx = el.get('cx'); cy = el.get('cy')
-            center = circle_center(cx, cy)
-            if center:
-                x,y = center
-                nid = index.add(x,y, preferred_id=el.get('id'), source='circle')
-                # If this circle is likely a building marker (has id or class), add to buildings
-                if el.get('id') or (el.get('class') and 'node' in el.get('class')):
-                    buildings.append({'id': el.get('id') or nid, 'nombreEdificio': el.get('id') or nid, 'coordX': x, 'coordY': y})
-        elif tag_local == 'rect':
-            xattr = el.get('x'); yattr = el.get('y'); wattr = el.get('width'); hattr = el.get('height')
-            center = rect_center(xattr, yattr, wattr, hattr)
-            if center:
-                x,y = center
-                nid = index.add(x,y, preferred_id=el.get('id'), source='rect')
-                if el.get('id'):
-                    buildings.append({'id': el.get('id'), 'nombreEdificio': el.get('id'), 'coordX': x, 'coordY': y})
-
-    # dedupe edges (unordered)
-    seen = set()
-    unique_edges = []
-    for e in edges:
-        key = (e['from'], e['to'])
-        if key in seen: continue
-        seen.add(key)
-        unique_edges.append(e)
-
-    return {
-        'generatedAt': datetime.utcnow().isoformat(),
-        'nodes': index.nodes,
-        'edges': unique_edges,
+                else:
+                    # polyline/polygon: peso desde el punto original, no el nodo agrupado
+                    dist = math.hypot(x - a['x'], y - a['y'])
+                edges.append({'from': prev_id, 'to': nid, 'weight': dist})
+            prev_id = nid
+    elif tag == 'circle':
+        if pts:
+            x,y = pts[0]
+            nid = index.add(x,y, preferred_id=el.get('id'), source='circle')
+            node_ids.append(nid)
+            # If this circle is likely a building marker (has id or class), add to buildings
+            if el.get('id') or (el.get('class') and 'node' in el.get('class')):
+                building = {'id': el.get('id') or nid, 'nombreEdificio': el.get('id') or nid, 'coordX': x, 'coordY': y}
+    elif tag == 'rect':
+        if pts:
+            x,y = pts[0]
+            nid = index.add(x,y, preferred_id=el.get('id'), source='rect')
+            node_ids.append(nid)
+            if el.get('id'):
+                building = {'id': el.get('id'), 'nombreEdificio': el.get('id'), 'coordX': x, 'coordY': y}
+    return node_ids, edges, building
+
+
+def affected_elements(current, points, seeds, tol):
+    """Claves de los elementos que deben reextraerse.
+
+    Parte de los elementos añadidos (ya incluidos en `seeds`) y de las
+    coordenadas de los nodos de los eliminados, y añade cualquier elemento con
+    un punto a menos de `tol` de un punto afectado, hasta cerrar la zona. Fuera
+    de ella ningún punto puede agruparse con uno de dentro, así que reextraer
+    sólo la zona da el mismo grafo que una extracción completa.
+    """
+    cell = tol if tol > 0 else 1.0
+    grid = {}
+    for key, _, _, _ in current:
+        if key in seeds['keys']:
+            continue
+        for (x,y) in points[key]:
+            grid.setdefault((math.floor(x/cell), math.floor(y/cell)), []).append((key, x, y))
+    affected = set(seeds['keys'])
+    pending = list(seeds['points'])
+    for key in affected:
+        pending.extend(points.get(key, []))
+    while pending:
+        x, y = pending.pop()
+        cx, cy = math.floor(x/cell), math.floor(y/cell)
+        for gx in (cx-1, cx, cx+1):
+            for gy in (cy-1, cy, cy+1):
+                for key, px, py in grid.get((gx, gy), ()):
+                    if key not in affected and math.hypot(px-x, py-y) <= tol:
+                        affected.add(key)
+                        pending.extend(points[key])
+    return affected
+
+
+def node_sort_key(nid):
+    """Ordena nN por su número (n2 antes que n10); otros ids van al final."""
+    m = re.fullmatch(r'n(\d+)', nid)
+    return (0, int(m.group(1)), '') if m else (1, 0, nid)
+
+
+def output_fingerprint(result):
+    """Hash del grafo escrito, para detectar salidas que no vienen del manifiesto."""
+    payload = json.dumps([result.get('nodes'), result.get('edges'), result.get('buildings')],
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def _valid_element(e):
+    return (isinstance(e, dict)
+            and isinstance(e.get('nodes'), list) and all(isinstance(n, str) for n in e['nodes'])
+            and isinstance(e.get('edges'), list)
+            and all(isinstance(p, list) and len(p) == 2 for p in e['edges'])
+            and (e.get('building') is None or isinstance(e['building'], dict)))
+
+
+def _manifest_usable(manifest, previous, tolerance):
+    # JSON válido pero con otra forma también obliga a extraer todo de nuevo
+    if not isinstance(manifest, dict) or not isinstance(previous, dict):
+        return False
+    elements = manifest.get('elements')
+    if not isinstance(elements, dict) or not all(_valid_element(e) for e in elements.values()):
+        return False
+    if not isinstance(manifest.get('nextSeq'), int):
+        return False
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('tolerance') != tolerance:
+        return False
+    # la salida previa tiene que ser exactamente la que produjo este manifiesto
+    # (p. ej. no sirve si otro script o un -o distinto la sobrescribió)
+    return manifest.get('outputHash') == output_fingerprint(previous)
+
+
+def extract_incremental(svg_path: Path, tolerance: float=1.0, previous=None, manifest=None):
+    """Extrae el grafo reutilizando `previous` (salida anterior) y su manifiesto.
+
+    Sólo se reextraen los elementos añadidos o modificados y los que comparten
+    zona (dentro de la tolerancia) con ellos o con los eliminados; el resto del
+    grafo se conserva tal cual, con los mismos ids. Si no hay manifiesto válido
+    se hace una extracción completa.
+
+    Devuelve (resultado, manifiesto nuevo, cambios).
+    """
+    tree = ET.parse(svg_path)
+    current = iter_graph_elements(tree.getroot())
+
+    incremental = _manifest_usable(manifest, previous, tolerance)
+    old_elements = manifest['elements'] if incremental else {}
+    old_nodes = {n['id']: n for n in previous['nodes']} if incremental else {}
+    current_keys = {key for key, _, _, _ in current}
+    removed_keys = [k for k in old_elements if k not in current_keys]
+    added_keys = [key for key, _, _, _ in current if key not in old_elements]
+
+    if incremental:
+        points = {key: element_points(tag, el) for key, _, tag, el in current}
+        seeds = {'keys': set(added_keys),
+                 'points': [(old_nodes[nid]['x'], old_nodes[nid]['y'])
+                            for k in removed_keys for nid in old_elements[k]['nodes'] if nid in old_nodes]}
+        region = affected_elements(current, points, seeds, tolerance)
+    else:
+        region = current_keys
+    # elementos de la extracción anterior cuyo aporte se descarta
+    stale = removed_keys + [k for k in old_elements if k in region]
+    unaffected = {k: e for k, e in old_elements.items() if k in current_keys and k not in region}
+
+    keep_ids = {nid for e in unaffected.values() for nid in e['nodes']}
+    stale_ids = {nid for k in stale for nid in old_elements[k]['nodes']} - keep_ids
+    stale_pairs = {tuple(p) for k in stale for p in old_elements[k]['edges']}
+    stale_pairs -= {tuple(p) for e in unaffected.values() for p in e['edges']}
+
+    # 1) reextraer la zona en un índice propio, en orden de documento; los ids
+    #    de los nodos descartados quedan en reserva para los puntos cercanos
+    index = NodeIndex(tol=tolerance,
+                      taken=set(old_nodes) - stale_ids,
+                      pool={nid: old_nodes[nid] for nid in stale_ids if nid in old_nodes},
+                      next_seq=manifest['nextSeq'] if incremental else 0)
+    new_elements = dict(unaffected)
+    region_edges = []
+    region_pairs = set()
+    region_buildings = []
+    for key, h, tag, el in current:
+        if key not in region:
+            continue
+        node_ids, el_edges, building = extract_element(tag, el, index)
+        for e in el_edges:
+            pair = (e['from'], e['to'])
+            if pair not in region_pairs:
+                region_pairs.add(pair)
+                region_edges.append(e)
+        if building:
+            region_buildings.append(building)
+        new_elements[key] = {'tag': tag, 'hash': h, 'nodes': node_ids,
+                             'edges': [[e['from'], e['to']] for e in el_edges],
+                             'building': building}
+
+    # 2) parchear el grafo anterior con el resultado de la zona
+    if incremental:
+        nodes = [dict(n) for n in previous['nodes'] if n['id'] not in stale_ids]
+        edges = [dict(e) for e in previous.get('edges', []) if (e['from'], e['to']) not in stale_pairs]
+        buildings = [dict(b) for b in previous.get('buildings', [])]
+        # los ids de edificio pueden repetirse (círculos que caen en el mismo
+        # nodo): se quita una sola entrada por elemento descartado
+        for k in stale:
+            b = old_elements[k].get('building')
+            if b and b in buildings:
+                buildings.remove(b)
+        generated_at = previous.get('generatedAt')
+    else:
+        nodes, edges, buildings, generated_at = [], [], [], None
+    nodes.extend(index.nodes)
+    edges.extend(region_edges)
+    buildings.extend(region_buildings)
+
+    # conserva el orden de documento en el manifiesto
+    new_elements = {key: new_elements[key] for key, _, _, _ in current}
+
+    # zona afectada, para que las etapas siguientes (edificios, rutas) sólo
+    # rehagan lo necesario; fullRebuild indica que todo el grafo es nuevo
+    old_weights = {(e['from'], e['to']): e['weight'] for e in previous.get('edges', [])
+                   if (e['from'], e['to']) in stale_pairs} if incremental else {}
+    new_weights = {(e['from'], e['to']): e['weight'] for e in region_edges}
+    changes = {
+        'fullRebuild': not incremental,
+        'addedElements': len(added_keys),
+        'removedElements': len(removed_keys),
+        'addedNodes': sorted((nid for nid in index.by_id if nid not in stale_ids), key=node_sort_key),
+        'removedNodes': sorted((nid for nid in stale_ids if nid not in index.by_id), key=node_sort_key),
+        # ids reutilizados cuyo nodo se desplazó
+        'changedNodes': sorted((nid for nid, n in index.by_id.items() if nid in old_nodes
+                                and (old_nodes[nid]['x'], old_nodes[nid]['y']) != (n['x'], n['y'])),
+                               key=node_sort_key),
+        'addedEdges': [list(p) for p in new_weights if p not in old_weights],
+        'removedEdges': [list(p) for p in old_weights if p not in new_weights],
+        'changedEdges': [list(p) for p in new_weights if p in old_weights and old_weights[p] != new_weights[p]],
+    }
+    if generated_at is None or added_keys or removed_keys:
+        generated_at = datetime.utcnow().isoformat()
+
+    result = {
+        'generatedAt': generated_at,
+        'nodes': nodes,
+        'edges': edges,
         'buildings': buildings
     }
+    new_manifest = {
+        'version': MANIFEST_VERSION,
+        'tolerance': tolerance,
+        'nextSeq': index.next_seq,
+        'outputHash': output_fingerprint(result),
+        'elements': new_elements,
+        'lastChanges': changes,
+    }
+    return result, new_manifest, changes
+
+
+def graph_signature(result):
+    """Forma del grafo sin ids: nodos, aristas y edificios por coordenadas."""
+    pos = {n['id']: (n['x'], n['y']) for n in result['nodes']}
+    nodes = sorted((n['x'], n['y'], n['source']) for n in result['nodes'])
+    edges = sorted((pos[e['from']], pos[e['to']], e['weight']) for e in result['edges'])
+    # los edificios sin id propio se llaman como su nodo, que puede cambiar
+    buildings = sorted((b['coordX'], b['coordY'], '' if b['id'] in pos else b['id'])
+                       for b in result['buildings'])
+    return nodes, edges, buildings
+
+
+def same_graph(a, b):
+    """True si dos resultados son iguales salvo por los ids de nodo."""
+    return graph_signature(a) == graph_signature(b)
+
+
+def extract(svg_path: Path, tolerance: float=1.0):
+    result, _, _ = extract_incremental(svg_path, tolerance=tolerance)
+    return result
+
+
+def load_json(path: Path):
+    if path is None or not path.exists():
+        return None
+    try:
+        return json.loads(path.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return None
 
 
 def main():
@@ -189,6 +470,9 @@ def main():
     p.add_argument('svg', type=Path, help='SVG de entrada')
     p.add_argument('-o','--output', type=Path, default=Path('map_nodes.json'), help='JSON de salida')
     p.add_argument('--tolerance', type=float, default=1.0, help='Tolerancia para unir puntos cercanos (px)')
+    p.add_argument('--manifest', type=Path, help='Manifiesto de hashes por elemento (por defecto <salida>.manifest.json)')
+    p.add_argument('--full', action='store_true', help='Ignora el manifiesto y reextrae todo el SVG')
+    p.add_argument('--check', action='store_true', help='Compara el resultado incremental con una extracción completa')
     p.add_argument('--also-generate-edificios-json', type=Path, help='Si se pasa, genera también un JSON tipo edificios (id,nombreEdificio,coordX,coordY)')
     args = p.parse_args()
 
@@ -197,10 +481,25 @@ def main():
         print('Error: SVG no encontrado:', svg_path)
         return 2
 
-    result = extract(svg_path, tolerance=args.tolerance)
     out_path = args.output
+    manifest_path = args.manifest or default_manifest_path(out_path)
+    previous = manifest = None
+    if not args.full:
+        previous = load_json(out_path)
+        manifest = load_json(manifest_path)
+    result, manifest, changes = extract_incremental(svg_path, tolerance=args.tolerance,
+                                                    previous=previous, manifest=manifest)
+    if args.check and not changes['fullRebuild']:
+        if not same_graph(result, extract(svg_path, tolerance=args.tolerance)):
+            print('Error: el grafo incremental no coincide con una extracción completa (use --full)')
+            return 1
+        print('Comprobado: coincide con una extracción completa')
     out_path.write_text(json.dumps(result, indent=2, ensure_ascii=False), encoding='utf-8')
+    manifest_path.write_text(json.dumps(manifest, indent=2, ensure_ascii=False), encoding='utf-8')
     print('Guardado:', out_path)
+    print(f"Elementos: +{changes['addedElements']} -{changes['removedElements']}; "
+          f"nodos: +{len(changes['addedNodes'])} -{len(changes['removedNodes'])} "
+          f"~{len(changes['changedNodes'])}")
     if args.also_generate_edificios_json:
         # use buildings if present, otherwise create edificios from nodes (first N)
         if result.get('buildings'):